@@ -18,6 +18,7 @@ def build_dir_structure():
         const.INTERMEDIATE_TIF,
         const.INTERMEDIATE_TIF_MODIS,
         const.INTERMEDIATE_TIF_VIIRS,
+        const.VIIRS_LUT,
         const.INTERMEDIATE_TIF_SENTINEL,
         const.INTERMEDIATE_TIF_PLOT,
         const.NORM,
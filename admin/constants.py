@@ -41,6 +41,8 @@ PLOT_VIIRS_BASINS = os.path.join(PLOT_VIIRS,'basins')
 PLOT_SENTINEL = os.path.join(PLOT,'sentinel')
 ANALYSIS = os.path.join(TOP,'analysis')
 MODIS_TERRA = os.path.join(TOP,'modis-terra')
+# Kept outside INTERMEDIATE_TIF so teardown of intermediate files does not drop the cache
+VIIRS_LUT = os.path.join(TOP,'viirs_lut')
 SENTINEL_OUTPUT = os.path.join(TOP, 'sentinel_output')
 
 NORM = os.path.join(os.environ['NORM_ROOT'],'norm')
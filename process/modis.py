@@ -7,7 +7,7 @@ import datetime
 
 import admin.constants as const
 
-from process.support import process_by_watershed_or_basin
+from process.support import process_by_watershed_or_basin, clean_intermediate_tifs
 from admin.color_ramp import color_ramp
 
 from osgeo import gdal
@@ -191,14 +191,6 @@ def get_datespan(date: str, days: int) -> List[str]:
         date_query.append(fmt_date(pydate - datetime.timedelta(days=d)))
     return date_query
 
-def clean_intermediate(date):
-    residual_files = glob(os.path.join(const.INTERMEDIATE_TIF_MODIS,date,'*.tif'))
-    if len(residual_files) != 0:
-        logger.info('Cleaning up residual files...')
-        for f in residual_files:
-            logger.debug(f"delete: {f}")
-            os.remove(f)
-
 def process_modis(startdate, days):
     """
     Main trigger for processing modis from HDF4 -> GTiff and 
@@ -224,7 +216,7 @@ def process_modis(startdate, days):
             os.makedirs(intTif)
             logger.debug(f"created folder: {intTif}")
         modis_granules = glob(os.path.join(pth, date,'*.hdf'))
-        clean_intermediate(date)
+        clean_intermediate_tifs('modis', date)
 
         logger.info(f'REPROJ GRANULES: {date}')
         reproj_args = []
@@ -113,4 +113,24 @@ def process_by_watershed_or_basin(sat: str, typ: str, startdate: str):
             with rioxr.open_rasterio(os.path.join(norm20yr_base, f'{d_splt[1]}.{d_splt[2]}.tif')) as norm20yr:
                 out_pth = os.path.join(os.path.split(output_pth)[0], f'{name}_20yrNorm.tif')
                 norm = norm20yr.rio.clip([row.geometry], drop=True, all_touched=True)
-            process_normals(norm, clipped_, row.geometry, out_pth, sat)
\ No newline at end of file
+            process_normals(norm, clipped_, row.geometry, out_pth, sat)
+
+def clean_intermediate_tifs(sat: str, date: str):
+    """
+    Remove the intermediate GTiffs of a satellite source for a date
+    once they are no longer needed
+
+    Parameters
+    ----------
+    sat : str
+        Source satellite [modis | viirs]
+    date : str
+        The target date of the intermediate files in format YYYY.MM.DD
+    """
+    residual_files = glob(os.path.join(const.INTERMEDIATE_TIF, sat, date, '*.tif'))
+    residual_files += glob(os.path.join(const.INTERMEDIATE_TIF, sat, date, '*.part')) # Interrupted writes
+    if len(residual_files) != 0:
+        logger.info('Cleaning up residual files...')
+        for f in residual_files:
+            logger.debug(f"delete: {f}")
+            os.remove(f)
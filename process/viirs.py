@@ -1,27 +1,127 @@
 import os
+import re
+import math
 import h5py
+import hashlib
 import logging
+import threading
 
 import numpy as np
 import rasterio as rio
 
 import admin.constants as const
 
-from process.support import process_by_watershed_or_basin
+from process.support import process_by_watershed_or_basin, clean_intermediate_tifs
 from admin.color_ramp import color_ramp
 
 from osgeo import gdal
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from rasterio.merge import merge
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.crs import CRS
+from rasterio.transform import Affine, from_origin
+from rasterio.warp import transform_bounds, reproject, Resampling
+from rasterio.windows import Window, transform as window_transform
 
 logger = logging.getLogger(__name__)
 
-def build_viirs_tif(date: str, scene: str):
+# Upper left corner of the grid in the HDF-EOS StructMetadata, e.g. UpperLeftPointMtrs=(-11119505.196667,6671703.118000)
+ULC_PATTERN = re.compile(rb'UpperLeftPointMtrs=\(([-0-9.eE+]+),([-0-9.eE+]+)\)')
+
+def get_out_tif(date: str, scene: str) -> str:
     """
-    Build GTiff from raw HDF5 format so the pipeline can 
-    use the /data
+    Path of the reprojected intermediate GTiff built from a granule
+
+    Parameters
+    ----------
+    date : str
+        The aquisition date of the granule in format YYYY.MM.DD
+    scene : str
+        Raw/HDF5 granule path
+    Returns
+    ----------
+    out_tif : str
+        Path to the granule's <name>_out.tif
+    """
+    name = ".".join(os.path.split(scene)[-1].split('.')[:-1])
+    return os.path.join(const.INTERMEDIATE_TIF_VIIRS, date, f'{name}_out.tif')
+
+def is_current(out_tif: str, scene: str) -> bool:
+    """
+    Check whether a reprojected intermediate GTiff can be reused
+
+    Parameters
+    ----------
+    out_tif : str
+        Path to the reprojected intermediate GTiff
+    scene : str
+        Raw/HDF5 granule path the GTiff was built from
+    Returns
+    ----------
+    current : bool
+        True if out_tif exists and was written after its source granule
+    """
+    return os.path.exists(out_tif) and os.path.getmtime(out_tif) > os.path.getmtime(scene)
+
+def get_reproject_lut(src_transform: Affine, src_crs: CRS, src_shape: tuple,
+                      dst_transform: Affine, dst_crs: str, dst_shape: tuple) -> np.ndarray:
+    """
+    Nearest neighbour lookup table from destination pixels to flat source
+    pixel indices. Granules of the same VIIRS tile share a footprint, so
+    the table is cached on disk under VIIRS_LUT and reprojecting a tile
+    becomes one gather
+
+    Parameters
+    ----------
+    src_transform : Affine
+        Transform of the source granule grid
+    src_crs : CRS
+        CRS of the source granule
+    src_shape : tuple
+        (rows, cols) of the source granule
+    dst_transform : Affine
+        Transform of the destination window
+    dst_crs : str
+        The destination CRS
+    dst_shape : tuple
+        (rows, cols) of the destination window
+    Returns
+    ----------
+    lut : np.ndarray
+        int32 array of dst_shape holding source indices, -1 where no source pixel maps
+    """
+    key = repr((tuple(src_transform), src_crs.to_wkt(), tuple(src_shape),
+                tuple(dst_transform), str(dst_crs), tuple(dst_shape)))
+    lut_pth = os.path.join(const.VIIRS_LUT, f'{hashlib.sha1(key.encode()).hexdigest()}.npy')
+    if os.path.exists(lut_pth):
+        return np.load(lut_pth)
+
+    # Reprojecting the pixel indices with nearest resampling yields the source pixel of every output pixel
+    lut = np.full(dst_shape, -1, dtype=np.int32)
+    reproject(
+        source=np.arange(src_shape[0] * src_shape[1], dtype=np.int32).reshape(src_shape),
+        destination=lut,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        src_nodata=-1,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=-1,
+        resampling=Resampling.nearest,
+        num_threads=1, # Parallelism comes from distribute: one granule per thread
+        warp_mem_limit=512
+    )
+    # Save under a temporary name so concurrent workers never load a partial table
+    tmp_pth = f'{lut_pth}.{threading.get_ident()}.part'
+    with open(tmp_pth, 'wb') as fh:
+        np.save(fh, lut)
+    os.replace(tmp_pth, lut_pth)
+    return lut
+
+def build_and_reproject(date: str, scene: str, dst_crs: str, grid_transform: Affine, grid_shape: tuple):
+    """
+    Build a reprojected GTiff straight from the raw HDF5 granule
+    so the pipeline can use the /data without an unprojected
+    intermediate GTiff
 
     Parameters
     ----------
@@ -30,11 +130,20 @@ def build_viirs_tif(date: str, scene: str):
         to set up intermediate files in format YYYY.MM.DD
     scene : str
         Raw/HDF5 granule path
+    dst_crs : str
+        The destination CRS to be reprojected to
+    grid_transform : Affine
+        Transform of the daily mosaic grid in dst_crs that
+        the granule is snapped onto
+    grid_shape : tuple
+        (rows, cols) of the daily mosaic grid
     Ref:
         url: https://lpdaac.usgs.gov/resources/e-learning/working-daily-nasa-viirs-surface-reflectance-/data/
     """
-    name = ".".join(os.path.split(scene)[-1].split('.')[:-1])
-    dest = os.path.join(const.INTERMEDIATE_TIF_VIIRS, date, f'{name}.tif')
+    intermediate_tif = get_out_tif(date, scene)
+    if is_current(intermediate_tif, scene):
+        logger.debug(f'skipping up to date: {intermediate_tif}')
+        return
     
     prj = 'PROJCS["unnamed",\
         GEOGCS["Unknown datum based upon the custom spheroid", \
@@ -48,133 +157,142 @@ def build_viirs_tif(date: str, scene: str):
         PARAMETER["false_northing",0], \
         UNIT["Meter",1]]'
     
-    f = h5py.File(scene, 'r')
-    fileMetadata = f['HDFEOS INFORMATION']['StructMetadata.0'][()].split() # Read file metadata
-    fileMetadata = [m.decode('utf-8') for m in fileMetadata]
-
-    grids = list(f['HDFEOS']['GRIDS']) # List contents of GRIDS directory
-
-    h5_objs = []            # Create empty list
-    f.visit(h5_objs.append) # Walk through directory tree, retrieve objects and append to list
-
-    all_datasets = [obj for grid in grids for obj in h5_objs if isinstance(f[obj],h5py.Dataset) and grid in obj] 
-
-    snow = f[[a for a in all_datasets if 'CGF_NDSI_Snow_Cover' in a][0]] # Cloud gap filled
-    #snow = f[[a for a in all_datasets if 'VNP10A1_NDSI_Snow_Cover' in a][0]] # Non-cloud gap filled
-    try: # Due to 2018 viirs missing a fill value: default to documented fillvalue
-        fillValue = snow.attrs['_FillValue'][0] # Set fill value to a variable
-    except:
-        fillValue = 255
-    snow = np.array(list(snow))
-    ulc = [i for i in fileMetadata if 'UpperLeftPointMtrs' in i][0]    # Search file metadata for the upper left corner of the file
-    ulcLon = float(ulc.split('=(')[-1].replace(')', '').split(',')[0]) # Parse metadata string for upper left corner lon value
-    ulcLat = float(ulc.split('=(')[-1].replace(')', '').split(',')[1]) # Parse metadata string for upper left corner lat value
-
-    yRes, xRes = -375,  375 # Define the x and y resolution   
-    geoInfo = (ulcLon, xRes, 0, ulcLat, 0, yRes)        # Define geotransform parameters
-
-    nRow, nCol = snow.shape[0], snow.shape[1]
-    driver = gdal.GetDriverByName('GTiff')
-    options = ['PROFILE=GeoTIFF']
-    outFile = driver.Create(dest, nCol, nRow, 1, options=options)
-    band = outFile.GetRasterBand(1)
-    band.WriteArray(snow)
-    band.FlushCache
-    band.SetNoDataValue(float(fillValue))                                                  
-    outFile.SetGeoTransform(geoInfo)
-    outFile.SetProjection(prj)
-    f.close()
-
-def reproject_viirs(date: str, name: str, src: str, dst_crs: str):
-    """Reproject viirs into the target CRS
+    # Chunk cache large enough to hold every chunk of the snow cover dataset; the file is
+    # closed before the output is built so the HDF5 caches are released first
+    with h5py.File(scene, 'r', rdcc_nbytes=64*1024*1024, rdcc_nslots=10007, rdcc_w0=0.75,
+                   libver='latest', swmr=False) as f:
+        fileMetadata = f['HDFEOS INFORMATION']['StructMetadata.0'][()] # Read raw file metadata
 
-    Parameters
-    ----------
-    name : str
-        A name string of the granule to be reprojected
-        to set up intermediate files
-    date : str
-        The aquisition date of the granule to be reprojected
-        to set up intermediate files in format YYYY.MM.DD
-    src : str
-        A string path to the granule
-    dst_crs : str
-        The destination CRS to be reprojected to
-    """
-    intermediate_tif = os.path.join(const.INTERMEDIATE_TIF_VIIRS,date,f'{name}_out.tif')
-    with rio.open(src, 'r') as src:
-        transform, width, height = calculate_default_transform(
-                                        src.crs, 
-                                        dst_crs, 
-                                        src.width, 
-                                        src.height, 
-                                        src.bounds.left, src.bounds.bottom,
-                                        src.bounds.right, src.bounds.top,
-                                        resolution=const.VIIRS_EPSG4326_RES
-                                    ) 
-        kwargs = src.meta.copy()
-        kwargs.update({
+        try:
+            snow = f['HDFEOS/GRIDS/VIIRS_Grid_IMG_2D/Data Fields/CGF_NDSI_Snow_Cover'] # Cloud gap filled
+            #snow = f['HDFEOS/GRIDS/VIIRS_Grid_IMG_2D/Data Fields/VNP10A1_NDSI_Snow_Cover'] # Non-cloud gap filled
+        except KeyError: # Granule layout differs from VNP10A1F: walk the tree for the dataset instead
+            logger.debug(f'CGF_NDSI_Snow_Cover not at expected path, searching granule: {scene}')
+            snow = f.visititems(
+                lambda name, obj: obj if isinstance(obj, h5py.Dataset) and name.endswith('CGF_NDSI_Snow_Cover') else None
+            )
+            if snow is None:
+                raise KeyError(f'CGF_NDSI_Snow_Cover dataset not found in granule: {scene}')
+        fv = snow.attrs.get('_FillValue') # 2018 viirs is missing a fill value: default to documented fillvalue
+        fillValue = int(fv[0]) if fv is not None else 255
+        ulc = ULC_PATTERN.search(fileMetadata) # Search file metadata for the upper left corner of the file
+        ulcLon, ulcLat = float(ulc.group(1)), float(ulc.group(2)) # Upper left corner lon/lat values
+
+        yRes, xRes = -375,  375 # Define the x and y resolution   
+
+        nRow, nCol = snow.shape[0], snow.shape[1]
+        src_crs = CRS.from_wkt(prj)
+        src_transform = from_origin(ulcLon, ulcLat, xRes, -yRes)
+
+        # Snap the tile footprint onto the shared mosaic grid instead of deriving
+        # a per-tile transform: cheap, and every tile lands pre-aligned for the mosaic
+        west, south, east, north = transform_bounds(
+                                        src_crs,
+                                        dst_crs,
+                                        ulcLon, ulcLat + nRow * yRes,
+                                        ulcLon + nCol * xRes, ulcLat
+                                    )
+        # Clip to the mosaic grid: only pixels that end up in the mosaic are reprojected and written
+        col_off = max(math.floor((west - grid_transform.c) / grid_transform.a), 0)
+        row_off = max(math.floor((north - grid_transform.f) / grid_transform.e), 0)
+        width = min(math.ceil((east - grid_transform.c) / grid_transform.a), grid_shape[1]) - col_off
+        height = min(math.ceil((south - grid_transform.f) / grid_transform.e), grid_shape[0]) - row_off
+        if width <= 0 or height <= 0:
+            logger.debug(f'skipping granule outside of mosaic bounds: {scene}')
+            return
+        transform = window_transform(Window(col_off, row_off, width, height), grid_transform)
+
+        snow_arr = np.empty(snow.shape, dtype=snow.dtype, order='C')
+        snow.read_direct(snow_arr) # Single bulk read straight into the buffer handed to reproject
+
+    # Larger block cache for the reproject and write; GDAL threading stays at one since
+    # distribute already runs a granule per core
+    with rio.Env(GDAL_CACHEMAX=512 * 1024 * 1024, GDAL_NUM_THREADS='1',
+                 CHECK_DISK_FREE_SPACE='NO', VSI_CACHE='TRUE'):
+        lut = get_reproject_lut(src_transform, src_crs, (nRow, nCol), transform, dst_crs, (height, width))
+        out_arr = snow_arr.ravel()[lut] # Nearest neighbour reproject as a single gather
+        out_arr[lut < 0] = fillValue
+        profile = {
             'driver': 'GTiff',
+            'height': height,
+            'width': width,
+            'count': 1,
+            'dtype': out_arr.dtype,
             'crs': dst_crs,
             'transform': transform,
-            'width': width,
-            'height': height
-        })
-        with rio.open(intermediate_tif, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rio.band(src, i),
-                    destination=rio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.nearest
-                )
+            'nodata': fillValue,
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256,
+            'compress': 'LZW',
+            'predictor': 2,
+            'BIGTIFF': 'IF_SAFER'
+        }
+        # Tiled + compressed so downstream block reads line up with the GDAL cache
+        # Written under a temporary name so an interrupted run never leaves a "current" partial tif
+        with rio.open(f'{intermediate_tif}.part', 'w', **profile) as dst:
+            dst.write(out_arr, 1)
+        os.replace(f'{intermediate_tif}.part', intermediate_tif)
 
 def create_viirs_mosaic(pth: str, startdate: str):
     """
-    Create a mosaic of all downloaded and reprojected tiffs
+    Create a colour ramped Cloud Optimized GeoTIFF mosaic
+    of all downloaded and reprojected tiffs
 
     Parameters
     ----------
     pth : str
         Path to directory of tiffs to be mosaic'ed
+    Returns
+    ----------
+    out_pth : str
+        Path to the written mosaic, or None if there were no tiffs to mosaic
     """
-    src_files_path = glob(os.path.join(pth,'*_out.tif'))
+    src_files_path = [e.path for e in os.scandir(pth) if e.name.endswith('_out.tif')]
     name = os.path.split(pth)[-1]
     out_pth = os.path.join(const.OUTPUT_TIF_VIIRS,startdate.split('.')[0],f'{name}.tif')
     try:
         os.makedirs(os.path.split(out_pth)[0])
     except Exception as e:
         logger.debug(e)
-    src_files_to_mosaic = []
-    for f in src_files_path:
-        src = rio.open(f, 'r')
-        src_files_to_mosaic.append(src)
-    if len(src_files_to_mosaic) != 0:
-        mosaic, out_trans = merge(
-            src_files_to_mosaic, 
-            bounds=[*const.BBOX],
-            res=const.VIIRS_EPSG4326_RES
-            )
-        out_meta = src.meta.copy()
-        out_meta.update({
-                "driver": "GTiff",
-                "height": mosaic.shape[1],
-                "width": mosaic.shape[2],
-                "transform": out_trans,
-                      })
-        with rio.open(out_pth, "w", **out_meta) as dst:
-            dst.write(mosaic)
-        for f in src_files_to_mosaic:
-            f.close()
+    if len(src_files_path) == 0:
+        logger.warning(f'No reprojected tiffs to mosaic in {pth}')
+        return None
+    # Virtual mosaic over the tiles, streamed block-by-block into the output
+    vrt_pth = f'/vsimem/viirs_mosaic_{name}.vrt'
+    vrt = gdal.BuildVRT(
+        vrt_pth,
+        src_files_path,
+        resolution='user',
+        xRes=const.VIIRS_EPSG4326_RES,
+        yRes=const.VIIRS_EPSG4326_RES,
+        outputBounds=[*const.BBOX],
+        resampleAlg='nearest'
+        )
+    if vrt is None:
+        raise RuntimeError(f'Could not build VIIRS mosaic VRT from {pth}: {gdal.GetLastErrorMsg()}')
+    del vrt
+    # Colour ramp goes on the VRT so the COG is written with its palette:
+    # updating the COG afterwards would break its tile/overview layout
+    color_ramp(vrt_pth)
+    ds = gdal.Translate(
+        out_pth,
+        vrt_pth,
+        format='COG',
+        creationOptions=['COMPRESS=LZW', 'BLOCKSIZE=512', 'NUM_THREADS=ALL_CPUS', 'PREDICTOR=YES', 'RESAMPLING=NEAREST', 'BIGTIFF=IF_SAFER'],
+        resampleAlg='nearest'
+        )
+    gdal.Unlink(vrt_pth)
+    if ds is None:
+        raise RuntimeError(f'Could not write VIIRS mosaic {out_pth}: {gdal.GetLastErrorMsg()}')
+    del ds # Flush and close the mosaic
     return out_pth
 
 def distribute(func, args):
-    # Multiprocessing support to manage Pool scope
-    with Pool(6) as p:
-        p.starmap(func, args)
+    # Thread support: workers spend their time in h5py/GDAL which release the GIL,
+    # and one process keeps a single shared GDAL block cache
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        list(ex.map(lambda a: func(*a), args))
 
 def process_viirs(date: str):
     """
@@ -193,32 +311,40 @@ def process_viirs(date: str):
     intermediate_pth = os.path.join(const.INTERMEDIATE_TIF_VIIRS, date)
     if not os.path.exists(intermediate_pth):
         os.makedirs(intermediate_pth)
+    if not os.path.exists(const.VIIRS_LUT):
+        os.makedirs(const.VIIRS_LUT)
+    # Tables left half saved by a worker that died before its rename
+    for f in glob(os.path.join(const.VIIRS_LUT, '*.part')):
+        logger.debug(f"delete: {f}")
+        os.remove(f)
     viirs_granules = glob(os.path.join(const.MODIS_TERRA, 'VNP10A1F.001', date, '*.h5'))    
     
-    residual_files = glob(os.path.join(intermediate_pth, '*.tif'))
+    # Keep reprojected tifs that are still newer than their granule so reruns skip them
+    current = [get_out_tif(date, g) for g in viirs_granules if is_current(get_out_tif(date, g), g)]
+    # Interrupted writes leave *.part files behind, which are never current
+    residual_files = glob(os.path.join(intermediate_pth, '*.part'))
+    residual_files += [f for f in glob(os.path.join(intermediate_pth, '*.tif')) if f not in current]
     if len(residual_files) != 0:
         logger.info('Cleaning up residual files...')
         for f in residual_files:
             os.remove(f)
 
-    logger.info('BUILDING INITIAL TIFS FROM HDF5')
-    proc_inputs = []
-    for i in range(len(viirs_granules)): 
-        proc_inputs.append((date, viirs_granules[i]))
-    distribute(build_viirs_tif, proc_inputs)
-    
-    logger.info('REPROJECTING TIFFS')
-    intermediate_tifs = glob(os.path.join(intermediate_pth, '*.tif'))
-    
-    reproj_args = []
-    for tif in intermediate_tifs:
-        name = ".".join(os.path.split(tif)[-1].split('.')[:-1])
-        reproj_args.append((date, name, tif, dst_crs))
-    distribute(reproject_viirs, reproj_args)
+    # Daily mosaic grid, computed once and shared by every granule
+    grid_transform = from_origin(const.BBOX[0], const.BBOX[3], const.VIIRS_EPSG4326_RES, const.VIIRS_EPSG4326_RES)
+    grid_shape = (
+        round((const.BBOX[3] - const.BBOX[1]) / const.VIIRS_EPSG4326_RES),
+        round((const.BBOX[2] - const.BBOX[0]) / const.VIIRS_EPSG4326_RES)
+    )
+
+    logger.info('BUILDING REPROJECTED TIFS FROM HDF5')
+    proc_inputs = [(date, g, dst_crs, grid_transform, grid_shape) for g in viirs_granules]
+    distribute(build_and_reproject, proc_inputs)
 
     logger.info('CREATING DAILY MOSAIC')
     out_pth = create_viirs_mosaic(intermediate_pth, date)
-    color_ramp(out_pth)
+    # Tiles are only kept around for reruns of a failed day
+    if out_pth is not None and os.path.exists(out_pth):
+        clean_intermediate_tifs('viirs', date)
 
     
     for task in ['watersheds', 'basins']: